@@ -1,2 +1,2 @@
 #!/bin/sh
-python3 ~/cleantweets/cleantweets.py --delete --config "settings.ini"
+python3 ~/cleantweets/cleantweets.py --delete --single-instance --config "settings.ini"
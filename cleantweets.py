@@ -7,12 +7,34 @@ import datetime
 import configparser
 import time
 import json
+import collections
+import heapq
+import multiprocessing
+import hashlib
+import http.client
+import socket
+import sqlite3
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+import concurrent.futures
 import tweepy
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    fcntl = None
 
 class TweetDeleter():
+    print_lock = threading.Lock()
+    read_limits = {"user_timeline": 900, "favorites": 75, "statuses_lookup": 900}  # Twitter's requests per 15 minutes and user
+    keep_list_interval = 1  # seconds between looks at the keep-list files
+    priority_limit = 20000  # candidates kept by --priority without --max-requests, more than a day of deletes
+
     def __init__(self, args=None):
         self.script_dir = os.path.dirname(os.path.realpath(sys.argv[0]))
         self.export_dir = os.path.join(self.script_dir, "exported_tweets")
+        self.state_dir = os.path.join(self.script_dir, "state")
         if args:
             self.export = args.export_tweets
             self.simulate = args.simulate
@@ -25,6 +47,19 @@ class TweetDeleter():
             self.liked_ids_to_keep = args.liked_ids_to_keep
             self.tweet_keywords_to_keep = args.tweet_keywords_to_keep
             self.liked_keywords_to_keep = args.liked_keywords_to_keep
+            self.chunk_size = args.chunk_size
+            self.lease_secs = args.lease_secs
+            self.rate_per_hour = args.rate_per_hour
+            self.max_runtime = args.max_runtime
+            self.max_requests = args.max_requests
+            self.priority = args.priority
+            self.archive_path = args.archive_path
+            self.export_media = args.export_media
+            self.media_workers = args.media_workers
+            self.raw_export = args.raw_export
+            self.hydrate_tweets = args.hydrate_tweets
+            self.shared_rate = args.shared_rate
+            self.jobs = args.jobs
             if args.config_path == "settings.ini":
                 self.config_path = os.path.join(self.script_dir, "settings.ini")
             else:
@@ -41,7 +76,36 @@ class TweetDeleter():
             self.liked_keywords_to_keep = []
             self.liked_threshold = -1
             self.retweet_threshold = -1
+            self.chunk_size = 100
+            self.lease_secs = 1200
+            self.rate_per_hour = None
+            self.max_runtime = None
+            self.max_requests = None
+            self.priority = None
+            self.archive_path = None
+            self.export_media = False
+            self.media_workers = 4
+            self.raw_export = False
+            self.hydrate_tweets = False
+            self.shared_rate = None
+            self.jobs = 1
             self.config_path = os.path.join(self.script_dir, "settings.ini")
+        self.watched_lists = {}
+        self.auth = None
+        self.shared_api = None
+        self.thread_state = threading.local()  # holds the API of a pipeline thread, see run_pipelines
+        self.rate_budget = None
+        self.shared_budgets = {}
+        self.account_key = None
+        self.instance_lock = None
+        self.start_time = time.time()
+        self.request_count = 0
+        self.gone_count = 0
+        self.archive_log = None
+        self.request_lock = threading.Lock()
+        self.keep_list_lock = threading.Lock()
+        self.keep_lists_checked = time.monotonic()
+        self.keep_lists_version = 0  # counts reloads that added entries
         if not os.path.exists(self.config_path):
             self.create_config_template()
         self.authenticate_from_config()  # check required settings first
@@ -52,10 +116,22 @@ class TweetDeleter():
                 pass
             except IOError as e:
                 raise(e)
+            if self.export_media:
+                self.setup_media_export()
 
         if self.api:
             self.check_config()  # load values from config if not provided as args
             self.validate_values()
+            if self.shared_rate:
+                self.setup_shared_budgets()
+
+    @property
+    def api(self):
+        return getattr(self.thread_state, "api", None) or self.shared_api
+
+    @api.setter
+    def api(self, api):
+        self.shared_api = api
 
     def __repr__(self):
         rep_str = "<TweetDeleter object"
@@ -65,6 +141,11 @@ class TweetDeleter():
         return rep_str
 
 
+    def log(self, *args):
+        # the delete and unlike pipelines may run in parallel, keep their lines apart
+        with self.print_lock:
+            print(*args)
+
     def check_config(self):
         # MINS TO WAIT
         if not self.mins_to_wait:
@@ -92,22 +173,22 @@ class TweetDeleter():
         if not self.tweet_ids_to_keep:
             p = self.load_from_config("DefaultPaths", "TweetIDsPath", None)
             if p:
-                self.tweet_ids_to_keep = self.list_loader(p, "tweet ID")
+                self.tweet_ids_to_keep = self.watch_list(p, "tweet_ids_to_keep", "tweet ID")
         # TWEET KWs TO KEEP
         if not self.tweet_keywords_to_keep:
             p = self.load_from_config("DefaultPaths", "TweetKeywordsPath", None)
             if p:
-                self.tweet_keywords_to_keep = self.list_loader(p, "tweet keyword")
+                self.tweet_keywords_to_keep = self.watch_list(p, "tweet_keywords_to_keep", "tweet keyword")
         # LIKED IDs TO KEEP
         if not self.liked_ids_to_keep:
             p = self.load_from_config("DefaultPaths", "LikedIDsPath", None)
             if p:
-                self.liked_ids_to_keep = self.list_loader(p, "liked tweet ID")
+                self.liked_ids_to_keep = self.watch_list(p, "liked_ids_to_keep", "liked tweet ID")
         # LIKED KWs TO KEEP
         if not self.liked_keywords_to_keep:
             p = self.load_from_config("DefaultPaths", "LikedKeywordsPath", None)
             if p:
-                self.liked_keywords_to_keep = self.list_loader(p, "liked tweet keyword")            
+                self.liked_keywords_to_keep = self.watch_list(p, "liked_keywords_to_keep", "liked tweet keyword")            
 
     def validate_values(self):
         # MINS TO WAIT
@@ -116,7 +197,7 @@ class TweetDeleter():
             if self.mins_to_wait == -1:
                 self.mins_to_wait = 15
         except TypeError:
-            print("Not a valid number of minutes to wait, defaulting to 15 minutes:\n{}".format(e))
+            self.log("Not a valid number of minutes to wait, defaulting to 15 minutes:\n{}".format(e))
             self.mins_to_wait = 15
         # DAYS TO KEEP
         try: 
@@ -124,7 +205,7 @@ class TweetDeleter():
             if self.days_to_keep == -1:
                 self.days_to_keep = 0
         except TypeError:
-            print("Not a valid number of days to keep, defaulting to 0 to ignore tweet age:\n{}".format(e))
+            self.log("Not a valid number of days to keep, defaulting to 0 to ignore tweet age:\n{}".format(e))
             self.days_to_keep = 0
         else:
             self.cutoff_date = datetime.datetime.utcnow() - datetime.timedelta(days=self.days_to_keep)
@@ -132,14 +213,17 @@ class TweetDeleter():
         try: 
             self.liked_threshold = int(self.liked_threshold)
         except TypeError:
-            print("Povide a threshold for likes, defaulting to -1 to ignore number of likes:\n{}".format(e))
+            self.log("Povide a threshold for likes, defaulting to -1 to ignore number of likes:\n{}".format(e))
             self.liked_threshold = -1
         # RETWEET THRESHOLD
         try: 
             self.retweet_threshold = int(self.retweet_threshold)
         except TypeError:
-            print("Provide a threshold for retweets, defaulting to -1 to ignore number of retweets:\n{}".format(e))
+            self.log("Provide a threshold for retweets, defaulting to -1 to ignore number of retweets:\n{}".format(e))
             self.retweet_threshold = -1
+        # IDs TO KEEP
+        self.tweet_ids_to_keep = set(self.tweet_ids_to_keep or [])
+        self.liked_ids_to_keep = set(self.liked_ids_to_keep or [])
 
     def load_from_config(self, section, option, fail_val):
         config = configparser.SafeConfigParser()
@@ -152,7 +236,7 @@ class TweetDeleter():
             try:
                 return config.get(section, option)
             except (configparser.NoSectionError, configparser.NoOptionError):
-                print("Could not load option {} from section {}. Please check the information in your configuration file.".format(option, section))            
+                self.log("Could not load option {} from section {}. Please check the information in your configuration file.".format(option, section))            
                 return fail_val
 
     def list_loader(self, list_path, list_type):
@@ -161,9 +245,53 @@ class TweetDeleter():
                 target = [l.strip("\n").strip() for l in h.readlines()]
                 return target
         except IOError:
-            print("Could not read {} file.".format(list_type))                
+            self.log("Could not read {} file.".format(list_type))                
             return None
 
+    def list_stamp(self, list_path):
+        try:
+            st = os.stat(list_path)
+        except OSError:
+            return None
+        return (st.st_mtime_ns, st.st_size)
+
+    def watch_list(self, list_path, attr, list_type):
+        self.watched_lists[attr] = (list_path, list_type, self.list_stamp(list_path))
+        return self.list_loader(list_path, list_type)
+
+    def reload_keep_lists(self):
+        # called for every tweet about to be deleted, so the files are only stat'ed once per keep_list_interval
+        now = time.monotonic()
+        if now - self.keep_lists_checked < self.keep_list_interval:
+            return False
+        with self.keep_list_lock:
+            self.keep_lists_checked = now
+            return self.reload_keep_lists_unlocked()
+
+    def reload_keep_lists_unlocked(self):
+        # pick up entries added to keep-list files while a run is in progress
+        changed = False
+        for attr, (list_path, list_type, stamp) in self.watched_lists.items():
+            current_stamp = self.list_stamp(list_path)
+            if current_stamp is None or current_stamp == stamp:
+                continue
+            self.watched_lists[attr] = (list_path, list_type, current_stamp)
+            loaded = self.list_loader(list_path, list_type)
+            if not loaded:
+                continue
+            known = getattr(self, attr) or []
+            added = [e for e in loaded if e and e not in known]
+            if added:
+                # swap in the whole list at once
+                if isinstance(known, set):
+                    setattr(self, attr, known.union(added))
+                else:
+                    setattr(self, attr, known + added)
+                changed = True
+                self.keep_lists_version += 1
+                self.log("Reloaded {} new {} entries from {}".format(len(added), list_type, list_path))
+        return changed
+
     def load_tweets_keywords_to_keep_from_file(self, str_path):
         self.tweet_keywords_to_keep = self.list_loader(str_path, "tweet keyword")
 
@@ -177,19 +305,19 @@ class TweetDeleter():
         try: 
             self.days_to_keep = int(days_to_keep)
         except TypeError:
-            print("Please provide a number of days to keep, set to 0 to delete all:\n{}".format(e))
+            self.log("Please provide a number of days to keep, set to 0 to delete all:\n{}".format(e))
         else:
             self.cutoff_date = datetime.datetime.utcnow() - datetime.timedelta(days=self.days_to_keep)
-            print("Keeping tweets/likes from the last {} days. Set cutoff date to {} (UTC)".format(self.days_to_keep, self.cutoff_date))        
+            self.log("Keeping tweets/likes from the last {} days. Set cutoff date to {} (UTC)".format(self.days_to_keep, self.cutoff_date))        
 
     def set_cutoff_date(self, cutoff_date):
         try:
             self.cutoff_date = datetime.datetime.strptime(cutoff_date, '%Y-%m-%d')
         except (TypeError, ValueError, NameError) as e:
-            print("Could not set a cutoff date. Please provide a date as a YYYY-MM-DD string:\n{}".format(e))
+            self.log("Could not set a cutoff date. Please provide a date as a YYYY-MM-DD string:\n{}".format(e))
         else:
             self.cutoff_date = datetime.datetime.strptime(cutoff_date, '%Y-%m-%d')
-            print("Set cutoff date to {} (UTC)".format(self.cutoff_date))
+            self.log("Set cutoff date to {} (UTC)".format(self.cutoff_date))
 
     def authenticate_from_config(self, config_path=None):
         if config_path is not None:
@@ -199,7 +327,7 @@ class TweetDeleter():
             with open(self.config_path) as h:
                 config.read_file(h)
         except IOError:
-            print("Please specify a valid config file.")
+            self.log("Please specify a valid config file.")
         else:
             try:
                 ck = config.get('Authentication', 'ConsumerKey')
@@ -207,30 +335,35 @@ class TweetDeleter():
                 at = config.get('Authentication', 'AccessToken')
                 ats = config.get('Authentication', 'AccessTokenSecret')
             except (configparser.NoSectionError,):
-                print("Please check the [Authentication] information in your configuration file.")
+                self.log("Please check the [Authentication] information in your configuration file.")
                 self.api = None
             else:
                 if all([ck, cs, at, ats]):
                     self.authenticate(ck, cs, at, ats)
                 else:
                     self.api = None
-                    print("Please check the options set under [Authentication] in your configuration file.")
+                    self.log("Please check the options set under [Authentication] in your configuration file.")
 
 
     def authenticate(self, consumer_key, consumer_secret, access_token, access_token_secret):
         auth = tweepy.OAuthHandler(consumer_key, consumer_secret)
         auth.set_access_token(access_token, access_token_secret)
-
-        self.api = tweepy.API(auth, wait_on_rate_limit_notify=True, wait_on_rate_limit=True)
+        self.account_key = hashlib.sha256(access_token.encode("utf-8")).hexdigest()[:16]  # names the state files of this account
+        self.auth = auth
+        self.api = self.create_api()
 
         try: 
             self.me = self.api.me()
             self.me = None  # only used to test access
         except tweepy.error.TweepError as e:
-            print("Please check the authentication information:\n{}".format(e))
+            self.log("Please check the authentication information:\n{}".format(e))
             self.api = None
             self.me = None
 
+    def create_api(self):
+        parser = RawCaptureParser() if self.export and self.raw_export else None
+        return tweepy.API(self.auth, parser=parser, wait_on_rate_limit_notify=True, wait_on_rate_limit=True)
+
     def create_config_template(self):
         config = configparser.SafeConfigParser()
         config.optionxform = str
@@ -249,16 +382,127 @@ class TweetDeleter():
         config.set("DefaultPaths", "LikedIDsPath", "")
         config.set("DefaultPaths", "TweetKeywordsPath", "")
         config.set("DefaultPaths", "LikedKeywordsPath", "")
-        print("Please specify a valid config file.")
+        self.log("Please specify a valid config file.")
         try:
             with open(self.config_path, "w") as h:
                 config.write(h)
         except IOError:
-            print("An empty configuration template has been created at {}".format(self.config_path))
+            self.log("An empty configuration template has been created at {}".format(self.config_path))
+
+    def setup_media_export(self):
+        self.media_dir = os.path.join(self.export_dir, "media")
+        self.media_index_path = os.path.join(self.media_dir, "index.jsonl")
+        self.media_lock = threading.Lock()
+        self.media_pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.media_workers)
+        self.media_pending = {}
+        self.media_index = {}  # url -> file name, shared by all runs using this export directory
+        try:
+            os.makedirs(self.media_dir)
+        except FileExistsError:
+            pass
+        try:
+            with open(self.media_index_path) as h:
+                for l in h:
+                    entry = json.loads(l)
+                    self.media_index[entry["url"]] = entry["file"]
+        except IOError:
+            pass
+
+    def media_urls(self, tweet):
+        # photos in full size, videos/GIFs in their best mp4 variant
+        urls = []
+        for m in tweet._json.get("extended_entities", {}).get("media", []):
+            variants = [v for v in m.get("video_info", {}).get("variants", []) if v.get("content_type") == "video/mp4"]
+            if variants:
+                urls.append(max(variants, key=lambda v: v.get("bitrate", 0))["url"])
+            elif m.get("media_url_https"):
+                urls.append(m["media_url_https"])
+        return urls
+
+    def download_media(self, url):
+        # resumes from a .part file left by an earlier attempt, stores the result under its content hash
+        part_path = os.path.join(self.media_dir, "{}.part".format(hashlib.sha1(url.encode("utf-8")).hexdigest()))
+        request = urllib.request.Request(url)
+        done = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        if done:
+            request.add_header("Range", "bytes={}-".format(done))
+        try:
+            with urllib.request.urlopen(request, timeout=60) as response:
+                with open(part_path, "ab" if response.getcode() == 206 else "wb") as h:
+                    while True:
+                        block = response.read(1 << 16)
+                        if not block:
+                            break
+                        h.write(block)
+        except urllib.error.HTTPError as e:
+            if not (done and e.code == 416):
+                raise
+            # range not satisfiable: the .part file already holds the whole file
+        digest = hashlib.sha256()
+        with open(part_path, "rb") as h:
+            for block in iter(lambda: h.read(1 << 16), b""):
+                digest.update(block)
+        ext = os.path.splitext(urllib.parse.urlparse(url).path)[1]
+        file_name = "{}{}".format(digest.hexdigest(), ext)
+        file_path = os.path.join(self.media_dir, file_name)
+        if os.path.exists(file_path):
+            os.remove(part_path)  # same content already downloaded for another URL
+        else:
+            os.replace(part_path, file_path)
+        with self.media_lock:
+            self.media_index[url] = file_name
+            with open(self.media_index_path, "a") as h:
+                h.write(json.dumps({"url": url, "file": file_name}) + "\n")
+        return file_name
+
+    def submit_media(self, tweet):
+        # starts the downloads of the tweet's media (unless already done or running), returns their futures
+        futures = {}
+        with self.media_lock:
+            for url in self.media_urls(tweet):
+                if url in self.media_index or url in futures:
+                    continue
+                if url not in self.media_pending:
+                    self.media_pending[url] = self.media_pool.submit(self.download_media, url)
+                futures[url] = self.media_pending[url]
+        return futures
+
+    def prefetch_media(self, tweets):
+        # downloads the media of the next few tweets while the current one is exported and deleted
+        if not (self.export and self.export_media):
+            for tweet in tweets:
+                yield tweet
+            return
+        window = collections.deque()
+        for tweet in tweets:
+            self.submit_media(tweet)
+            window.append(tweet)
+            if len(window) > 4*self.media_workers:
+                yield window.popleft()
+        while window:
+            yield window.popleft()
+
+    def export_media_files(self, tweet):
+        futures = self.submit_media(tweet)  # only waits for this tweet's own downloads
+        exported = True
+        for url, future in futures.items():
+            try:
+                future.result()
+            except (IOError, ValueError, http.client.HTTPException) as e:
+                self.log("\t\tCOULD NOT DOWNLOAD {} FOR {} ({})".format(url, tweet.id_str, tweet.created_at))
+                self.log("\t", e)
+                exported = False
+            with self.media_lock:
+                self.media_pending.pop(url, None)
+        if exported and futures and self.verbose:
+            self.log("\t\tDOWNLOADED {} MEDIA FILES FOR {}".format(len(futures), tweet.id_str))
+        return exported
 
     def export_to_json(self, tweet, fav=False):
         try:
-            json_str = json.dumps(tweet._json, sort_keys=True, indent=4)
+            json_str = getattr(tweet, "_raw_json", None)  # set by RawCaptureParser
+            if json_str is None:
+                json_str = json.dumps(tweet._json, sort_keys=True, indent=4)
             if fav:
                 json_path = os.path.join(self.export_dir, "liked_tweet_{}.json".format(tweet.id_str))
             else:
@@ -267,16 +511,19 @@ class TweetDeleter():
                 with open(json_path, "w") as h:
                     h.write(json_str)
             except IOError as e:
-                print("\t\tCOULD NOT EXPORT {} ({}), WON'T DELETE/UNLIKE.".format(tweet.id_str, tweet.created_at))
-                print("\t", e)
+                self.log("\t\tCOULD NOT EXPORT {} ({}), WON'T DELETE/UNLIKE.".format(tweet.id_str, tweet.created_at))
+                self.log("\t", e)
                 return False
             else:
+                if self.export_media and not self.export_media_files(tweet):
+                    self.log("\t\tCOULD NOT EXPORT MEDIA OF {} ({}), WON'T DELETE/UNLIKE.".format(tweet.id_str, tweet.created_at))
+                    return False
                 if self.verbose:
-                    print("\t\tEXPORTED {} ({})".format(tweet.id_str, tweet.created_at))
+                    self.log("\t\tEXPORTED {} ({})".format(tweet.id_str, tweet.created_at))
                 return True
         except (TypeError, json.decoder.JSONDecodeError) as e:
-            print("\t\tCOULD NOT EXPORT {} ({}), WON'T".format(tweet.id_str, tweet.created_at))
-            print("\t", e)
+            self.log("\t\tCOULD NOT EXPORT {} ({}), WON'T".format(tweet.id_str, tweet.created_at))
+            self.log("\t", e)
             return False
 
     def contains_keywords_to_keep(self, tweet, fav=False):
@@ -286,156 +533,793 @@ class TweetDeleter():
             protected = any([True for s in self.tweet_keywords_to_keep if s.lower() in tweet.text.lower()])
         return protected
 
+    def keep_rules(self, fav=False):
+        # the current keep settings for protected_by_rules; likes have no thresholds
+        if fav:
+            return {
+                "ids": self.liked_ids_to_keep,
+                "keywords": [k.lower() for k in self.liked_keywords_to_keep or []],
+                "cutoff": self.cutoff_date,
+                "liked_threshold": -1,
+                "retweet_threshold": -1,
+            }
+        return {
+            "ids": self.tweet_ids_to_keep,
+            "keywords": [k.lower() for k in self.tweet_keywords_to_keep or []],
+            "cutoff": self.cutoff_date,
+            "liked_threshold": self.liked_threshold,
+            "retweet_threshold": self.retweet_threshold,
+        }
+
     def is_protected_tweet(self, tweet):
-        protected = False
-        if tweet.id_str in self.tweet_ids_to_keep:
-            protected = True
-        elif tweet.created_at >= self.cutoff_date:
-            protected = True
-        elif self.contains_keywords_to_keep(tweet):
-            protected = True
-        elif self.liked_threshold != -1 and tweet.favorite_count >= self.liked_threshold:
-            protected = True
-        elif self.retweet_threshold != -1 and tweet.retweet_count >= self.retweet_threshold:
-            protected = True
-        return protected
+        return protected_by_rules(tweet.id_str, tweet.created_at, tweet.text, tweet.favorite_count, tweet.retweet_count, self.keep_rules())
 
     def is_protected_like(self, tweet):
-        protected = False
-        if tweet.id_str in self.liked_ids_to_keep:
-            protected = True
-        elif tweet.created_at >= self.cutoff_date:
-            protected = True
-        elif self.contains_keywords_to_keep(tweet, fav=True):
-            protected = True
-        return protected
+        return protected_by_rules(tweet.id_str, tweet.created_at, tweet.text, 0, 0, self.keep_rules(fav=True))
+
+    def setup_shared_budgets(self):
+        # one budget per rate limit family, shared by all runs with the same access token on this host
+        try:
+            os.makedirs(self.state_dir)
+        except FileExistsError:
+            pass
+        budget_path = os.path.join(self.state_dir, "budget_{}.sqlite".format(self.account_key))
+        self.shared_budgets = {
+            "destroy_status": RateBudget(budget_path, "statuses", self.shared_rate),
+            "destroy_favorite": RateBudget(budget_path, "favorites", self.shared_rate),
+        }
+        # reading pages counts against per-user 15 minute windows, which overlapping runs share as well
+        for name, per_window in self.read_limits.items():
+            self.shared_budgets[name] = RateBudget(budget_path, name, 4*per_window, capacity=per_window)
+
+    def setup_archive_log(self):
+        # archived tweets that earlier runs deleted or found gone, so every --archive run gets further
+        try:
+            os.makedirs(self.state_dir)
+        except FileExistsError:
+            pass
+        self.archive_log_path = os.path.join(self.state_dir, "archive_{}.sqlite".format(self.account_key))
+        self.archive_log = ArchiveLog(self.archive_log_path)
+
+    def acquire_instance_lock(self):
+        # held until the process exits; False if another run with the same access token holds it
+        if fcntl is None:
+            self.log("Single-instance locking is not supported on this platform, continuing without it.")
+            return True
+        try:
+            os.makedirs(self.state_dir)
+        except FileExistsError:
+            pass
+        self.instance_lock = open(os.path.join(self.state_dir, "run_{}.lock".format(self.account_key)), "w")
+        try:
+            fcntl.flock(self.instance_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            self.instance_lock.close()
+            self.instance_lock = None
+            return False
+        return True
+
+    def call_api(self, method, *args, fav=False, **kwargs):
+        # fav: the request counts against the favorites/* limits instead of statuses/*
+        for budget in (self.rate_budget, self.shared_budgets.get("destroy_favorite" if fav else "destroy_status")):
+            if budget:
+                budget.acquire()
+        self.count_request()
+        return method(*args, **kwargs)
+
+    def acquire_read_budget(self, name):
+        # before each page/lookup request, so overlapping runs do not run into Twitter's rate limits
+        budget = self.shared_budgets.get(name)
+        if budget:
+            budget.acquire()
+
+    def count_request(self):
+        with self.request_lock:
+            self.request_count += 1
+
+    def budget_exhausted(self, extra_secs=0):
+        if self.max_requests and self.request_count >= self.max_requests:
+            return "used up the budget of {} requests".format(self.max_requests)
+        if self.max_runtime and time.time() + extra_secs - self.start_time >= 60*self.max_runtime:
+            return "used up the budget of {} minutes".format(self.max_runtime)
+        return None
+
+    def collection_budget_exhausted(self):
+        # collecting candidates may use up to half of --max-runtime, the rest is left for processing them
+        if self.max_runtime and time.time() - self.start_time >= 30*self.max_runtime:
+            return "used up half of the budget of {} minutes collecting candidates".format(self.max_runtime)
+        return None
+
+    def fetch_tweets(self, fav=False, max_id=None):
+        # whole timeline/favorites, newest first, resuming where it stopped after errors
+        if fav:
+            name, method, kwargs = "favorites", self.api.favorites, {}
+        else:
+            name, method, kwargs = "user_timeline", self.api.user_timeline, {"include_rts": True}
+        while True:
+            if max_id:
+                kwargs["max_id"] = max_id
+            try:
+                pages = tweepy.Cursor(method, count=200, **kwargs).pages()
+                while True:
+                    self.acquire_read_budget(name)
+                    page = next(pages, None)
+                    if page is None:
+                        break
+                    for tweet in page:
+                        max_id = tweet.id - 1
+                        yield tweet
+            except tweepy.error.TweepError as e:
+                self.log(e)
+                reason = self.budget_exhausted(60*self.mins_to_wait)
+                if reason:
+                    self.log("Not resuming, {}.".format(reason))
+                    return
+                self.log("Waiting {} minutes before resuming ({})".format(self.mins_to_wait, datetime.datetime.now()))
+                time.sleep(60*self.mins_to_wait)
+                continue
+            return
+
+    def load_archive(self, archive_path):
+        # own tweets from a Twitter data archive (data/tweet.js) or a file with one tweet JSON object per line
+        try:
+            with open(archive_path, encoding="utf-8") as h:
+                for obj in iter_json_file(h):
+                    tweet = obj.get("tweet", obj)
+                    if self.archive_log and tweet["id_str"] in self.archive_log:
+                        self.gone_count += 1  # deleted by an earlier run
+                        continue
+                    yield tweepy.models.Status.parse(self.api, normalise_archive_tweet(tweet))
+        except IOError as e:
+            self.log("Could not read archive {}:\n{}".format(archive_path, e))
+        except ValueError as e:
+            self.log("Could not parse archive {}:\n{}".format(archive_path, e))
+
+    def lookup_tweets(self, ids):
+        # current state of the given tweets, 100 per statuses/lookup request; deleted tweets are missing
+        found = {}
+        for i in range(0, len(ids), 100):
+            self.acquire_read_budget("statuses_lookup")
+            try:
+                for tweet in self.api.statuses_lookup(ids[i:i + 100]):
+                    found[tweet.id_str] = tweet
+            except tweepy.error.TweepError as e:
+                self.log("Could not look up tweets, using the stored counts:\n{}".format(e))
+                return None
+        return found
+
+    def hydrate_batch(self, batch):
+        found = self.lookup_tweets([t.id_str for t in batch])
+        if found is None:
+            return batch
+        for t in batch:
+            if t.id_str not in found:
+                self.gone_count += 1
+                if self.archive_log:
+                    self.archive_log.add(t.id_str)
+                if self.verbose:
+                    self.log("\t\tALREADY GONE {} ({})".format(t.id_str, t.created_at))
+        return [self.refresh_counts(t, found[t.id_str]) for t in batch if t.id_str in found]
+
+    def refresh_counts(self, tweet, current):
+        # only the counts are taken from the lookup, its text is truncated (no tweet_mode="extended")
+        for key in ("favorite_count", "retweet_count"):
+            value = getattr(current, key)
+            setattr(tweet, key, value)
+            tweet._json[key] = value
+        return tweet
+
+    def hydrate(self, tweets):
+        # tweets from an archive with current likes/retweets, without those that no longer exist
+        exhausted = self.collection_budget_exhausted if self.priority else self.budget_exhausted
+        batch = []
+        for tweet in tweets:
+            batch.append(tweet)
+            if len(batch) == 100:
+                if exhausted():
+                    return
+                for t in self.hydrate_batch(batch):
+                    yield t
+                batch = []
+        if batch and not exhausted():
+            for t in self.hydrate_batch(batch):
+                yield t
+
+    def prioritise(self, tweets, fav=False):
+        # drop protected tweets and order the rest so the most important ones are removed first.
+        # Only as many candidates as the request budget (or priority_limit) allows are kept in memory,
+        # and only their JSON, not the parsed Status objects.
+        is_protected = self.is_protected_like if fav else self.is_protected_tweet
+        heap = []
+        candidate_count = 0
+        protected_count = 0
+        for seq, tweet in enumerate(tweets):
+            reason = self.collection_budget_exhausted()
+            if reason:
+                self.log("Stopped collecting, {}. The remaining tweets are left for the next run.".format(reason))
+                break
+            if is_protected(tweet):
+                protected_count += 1
+                continue
+            candidate_count += 1
+            # ids grow with time, so the smallest id is the oldest tweet
+            if self.priority == "engagement":
+                entry = (-(tweet.favorite_count + tweet.retweet_count), -int(tweet.id_str), -seq, tweet._json)
+            else:
+                entry = (-int(tweet.id_str), -seq, tweet._json)
+            if len(heap) < (self.max_requests or self.priority_limit):
+                heapq.heappush(heap, entry)
+            else:
+                heapq.heappushpop(heap, entry)
+        candidates = [entry[-1] for entry in sorted(heap)]  # most important last, for popping
+        del heap
+        return candidates, candidate_count, protected_count
+
+    def pop_candidates(self, candidates):
+        # parsed one at a time, only the JSON of the remaining candidates is kept
+        while candidates:
+            yield tweepy.models.Status.parse(self.api, candidates.pop())
+
+    def tweet_source(self, fav=False, max_id=None):
+        # own tweets from the archive if one is given (in file order), otherwise from the API, newest first
+        if self.archive_path and not fav:
+            tweets = self.load_archive(self.archive_path)
+            if self.hydrate_tweets:
+                tweets = self.hydrate(tweets)
+            return tweets
+        return self.fetch_tweets(fav, max_id=max_id)
+
+    def process_prioritised(self, fav=False):
+        candidates, candidate_count, ignored_count = self.prioritise(self.tweet_source(fav), fav)
+        self.log("Found {} candidates, processing {} first".format(candidate_count, self.priority))
+        deletion_count = 0
+        processed_count = 0
+        for tweet in self.prefetch_media(self.pop_candidates(candidates)):
+            reason = self.budget_exhausted()
+            if reason:
+                self.log("Stopping early, {}.".format(reason))
+                break
+            result = self.process_tweet(tweet, fav)
+            processed_count += 1
+            if result == "deleted":
+                deletion_count += 1
+            elif result == "protected":
+                ignored_count += 1
+        if processed_count < candidate_count:
+            self.log("{} candidates were left for the next run.".format(candidate_count - processed_count))
+        if self.gone_count:
+            self.log("{} tweets no longer existed and were skipped.".format(self.gone_count))
+        return deletion_count, ignored_count
+
+    def can_shard_archive(self):
+        # the shards know nothing of budgets, priorities, exports or lookups, those need the sequential path
+        blockers = [flag for flag, value in (("--export", self.export), ("--hydrate", self.hydrate_tweets), ("--priority", self.priority),
+                                             ("--max-requests", self.max_requests), ("--max-runtime", self.max_runtime)) if value]
+        if blockers:
+            self.log("Ignoring --jobs because of {}, evaluating the archive on one process.".format(", ".join(blockers)))
+        return not blockers
+
+    def evaluate_archive(self):
+        # simulation over a large archive on several cores, the results come back in file order
+        rules = self.keep_rules()
+        deletion_count = 0
+        ignored_count = 0
+        try:
+            shards = archive_shards(self.archive_path, self.jobs * 4)
+            self.log("Evaluating {} in {} shards on {} processes".format(self.archive_path, len(shards), self.jobs))
+            with multiprocessing.Pool(self.jobs, initializer=init_shard_worker, initargs=(rules, self.archive_log_path, self.verbose)) as pool:
+                for deleted, protected, gone, kept in pool.imap(evaluate_shard, shards):
+                    deletion_count += deleted
+                    ignored_count += protected
+                    self.gone_count += gone
+                    for id_str, created_at in kept:
+                        self.log("\t\tKEEPING {} ({})".format(id_str, created_at))
+        except IOError as e:
+            self.log("Could not read archive {}:\n{}".format(self.archive_path, e))
+        except ValueError as e:
+            self.log("Could not parse archive {}:\n{}".format(self.archive_path, e))
+        if self.gone_count:
+            self.log("{} tweets were deleted by earlier runs and skipped.".format(self.gone_count))
+        return deletion_count, ignored_count
+
+    def process_tweet(self, tweet, fav=False):
+        # export, check and delete/unlike a single tweet; returns "deleted", "protected", "gone" or "failed"
+        if self.export:
+            exported = self.export_to_json(tweet, fav=fav)
+        else:
+            exported = True  # pretend for easier checking below
+        is_protected = self.is_protected_like if fav else self.is_protected_tweet
+        version = self.keep_lists_version
+        protected = is_protected(tweet)
+        if not protected and (self.reload_keep_lists() or self.keep_lists_version != version):
+            protected = is_protected(tweet)  # also when the other pipeline thread just reloaded
+        if protected or not exported:
+            if self.verbose:
+                self.log("\t\tKEEPING {} ({})".format(tweet.id_str, tweet.created_at))
+            return "protected"
+        if self.simulate:
+            self.count_request()  # so --max-requests limits simulations the same way
+            return "deleted"
+        try:
+            if fav:
+                self.call_api(self.api.destroy_favorite, tweet.id_str, fav=True)
+            else:
+                self.call_api(self.api.destroy_status, tweet.id_str)
+        except tweepy.error.TweepError as e:
+            if is_not_found(e):
+                self.gone_count += 1  # deleted/unliked elsewhere, nothing left to do
+                if self.archive_log and not fav:
+                    self.archive_log.add(tweet.id_str)
+                if self.verbose:
+                    self.log("\t\tALREADY GONE {} ({})".format(tweet.id_str, tweet.created_at))
+                return "gone"
+            self.log("\t\tCOULD NOT {} {} ({})".format("UNLIKE" if fav else "DELETE", tweet.id_str, tweet.created_at))
+            self.log("\t", e)
+            return "failed"
+        if self.archive_log and not fav:
+            self.archive_log.add(tweet.id_str)
+        if self.verbose:
+            self.log("\t\t{} {} ({})".format("UNLIKED" if fav else "DELETED", tweet.id_str, tweet.created_at))
+        return "deleted"
 
     def delete_tweets(self, max_id = None):
-        error = False
-        last_id = None
         if not self.api:
-            print("Could not authenticate. Please check the options set under [Authentication] in your configuration file.")
+            self.log("Could not authenticate. Please check the options set under [Authentication] in your configuration file.")
             return
-        print("Deleting tweets older than {} (simulation={})".format(self.cutoff_date, self.simulate))
+        self.log("Deleting tweets older than {} (simulation={})".format(self.cutoff_date, self.simulate))
         if self.tweet_ids_to_keep:
-            print("Keeping tweets with the following ids: {}".format(",".join(self.tweet_ids_to_keep)))
+            self.log("Keeping tweets with the following ids: {}".format(",".join(self.tweet_ids_to_keep)))
         if self.tweet_keywords_to_keep:
-            print("Keeping tweets containing the following keywords (case-insensitive): {}".format(",".join(self.tweet_keywords_to_keep)))
+            self.log("Keeping tweets containing the following keywords (case-insensitive): {}".format(",".join(self.tweet_keywords_to_keep)))
         if self.retweet_threshold > -1:
-            print("Keeping tweets with at least {} retweets".format(self.retweet_threshold))
+            self.log("Keeping tweets with at least {} retweets".format(self.retweet_threshold))
         if self.liked_threshold > -1:
-            print("Keeping tweets with at least {} likes".format(self.liked_threshold))
-        deletion_count = 0
-        ignored_count = 0
-        if not max_id:
-            timeline = tweepy.Cursor(self.api.user_timeline, include_rts=True, count=200).items()
+            self.log("Keeping tweets with at least {} likes".format(self.liked_threshold))
+        if self.archive_path:
+            self.setup_archive_log()
+        if self.archive_path and self.simulate and self.jobs > 1 and self.can_shard_archive():
+            deletion_count, ignored_count = self.evaluate_archive()
+        elif self.priority:
+            deletion_count, ignored_count = self.process_prioritised()
         else:
-            timeline = tweepy.Cursor(self.api.user_timeline, include_rts=True, count=200, max_id=max_id).items()
-
-        while True:
-            try:
-                tweet = timeline.next()
-                if self.export:
-                    exported = self.export_to_json(tweet)
-                else:
-                    exported = True  # pretend for easier checking below
-                if not self.is_protected_tweet(tweet) and not self.simulate and exported:
-                    try:
-                        self.api.destroy_status(tweet.id_str) 
-                    except tweepy.error.TweepError as e:
-                        print("\t\tCOULD NOT DELETE {} ({})".format(tweet.id_str, tweet.created_at))
-                        print("\t", e)
-                    else:
-                        deletion_count += 1
-                        if self.verbose:
-                            print("\t\tDELETED {} ({})".format(tweet.id_str, tweet.created_at))
-                else:   
+            deletion_count = 0
+            ignored_count = 0
+            for tweet in self.prefetch_media(self.tweet_source(max_id=max_id)):
+                reason = self.budget_exhausted()
+                if reason:
+                    self.log("Stopping early, {}.".format(reason))
+                    break
+                result = self.process_tweet(tweet)
+                if result == "deleted":
+                    deletion_count += 1
+                elif result == "protected":
                     ignored_count += 1
-                    if self.verbose:
-                        print("\t\tKEEPING {} ({})".format(tweet.id_str, tweet.created_at))
-            except tweepy.error.TweepError as e:
-                print(e)
-                last_id = tweet.id
-                error = True
-                break
-            except StopIteration:
-                break
+            if self.gone_count:
+                self.log("{} tweets no longer existed and were skipped.".format(self.gone_count))
         if not self.simulate:
-            print("{} tweets were deleted. {} tweets were protected.".format(deletion_count, ignored_count))
+            self.log("{} tweets were deleted. {} tweets were protected.".format(deletion_count, ignored_count))
         else:
-            print("SIMULATION: {} tweets would be deleted. {} tweets would be protected.".format(deletion_count, ignored_count))
-        if error:
-            print("Waiting {} minutes before starting over ({})".format(self.mins_to_wait, datetime.datetime.now()))
-            time.sleep(60*self.mins_to_wait)            
-            self.delete_tweets(max_id=last_id)
-
-
+            self.log("SIMULATION: {} tweets would be deleted. {} tweets would be protected.".format(deletion_count, ignored_count))
+        return deletion_count, ignored_count
 
     def unlike_tweets(self, max_id=None):
-        error = False
-        last_id = None
         if not self.api:
-            print("Could not authenticate. Please check the options set under [Authentication] in your configuration file.")
+            self.log("Could not authenticate. Please check the options set under [Authentication] in your configuration file.")
             return
-        print("Unliking tweets older than {} (simulation={})".format(self.cutoff_date, self.simulate))
+        self.log("Unliking tweets older than {} (simulation={})".format(self.cutoff_date, self.simulate))
         if self.liked_ids_to_keep:
-            print("Keeping liked tweets with the following ids: {}".format(",".join(self.liked_ids_to_keep)))
+            self.log("Keeping liked tweets with the following ids: {}".format(",".join(self.liked_ids_to_keep)))
         if self.liked_keywords_to_keep: 
-            print("Keeping liked tweets containing the following keywords (case-insensitive): {}".format(",".join(self.liked_keywords_to_keep)))
+            self.log("Keeping liked tweets containing the following keywords (case-insensitive): {}".format(",".join(self.liked_keywords_to_keep)))
 
-        unliked_count = 0
-        ignored_count = 0
-        if max_id:
-            likes = tweepy.Cursor(self.api.favorites, count=200, max_id=max_id).items()
+        if self.priority:
+            unliked_count, ignored_count = self.process_prioritised(fav=True)
         else:
-            likes = tweepy.Cursor(self.api.favorites, count=200).items()
-        while True:
-            try:
-                tweet = likes.next()
-                if self.export:
-                    exported = self.export_to_json(tweet, fav=True)
-                else:
-                    exported = True  # pretend for easier checking below
-                if not self.is_protected_like(tweet) and not self.simulate and exported:
-                    try:
-                        self.api.destroy_favorite(tweet.id_str)
-                    except tweepy.error.TweepError as e:
-                        print("\t\tCOULD NOT UNLIKE {} ({})".format(tweet.id_str, tweet.created_at))
-                        print(e)
-                    else:
-                        unliked_count += 1
-                        if self.verbose:
-                            print("\t\tUNLIKED {} ({})".format(tweet.id_str, tweet.created_at))
-                else:
+            unliked_count = 0
+            ignored_count = 0
+            for tweet in self.prefetch_media(self.fetch_tweets(fav=True, max_id=max_id)):
+                reason = self.budget_exhausted()
+                if reason:
+                    self.log("Stopping early, {}.".format(reason))
+                    break
+                result = self.process_tweet(tweet, fav=True)
+                if result == "deleted":
+                    unliked_count += 1
+                elif result == "protected":
                     ignored_count += 1
-                    if self.verbose:
-                        print("\t\tKEEPING {} ({})".format(tweet.id_str, tweet.created_at))
-            except tweepy.error.TweepError as e:
-                print(e)
-                last_id = tweet.id
-                error = True
-                break
-            except StopIteration:
-                break
         if not self.simulate:
-            print("{} tweets were unliked. {} liked tweets were protected.".format(unliked_count, ignored_count))
+            self.log("{} tweets were unliked. {} liked tweets were protected.".format(unliked_count, ignored_count))
         else:
-            print("SIMULATION: {} tweets would be unliked. {} liked tweets would be protected.".format(unliked_count, ignored_count))
-        if error:
-            print("Waiting {} minutes, then starting over ({})".format(self.mins_to_wait, datetime.datetime.now()))
-            time.sleep(
-                60*self.mins_to_wait)            
-            self.unlike_tweets(max_id=last_id)
+            self.log("SIMULATION: {} tweets would be unliked. {} liked tweets would be protected.".format(unliked_count, ignored_count))
+        return unliked_count, ignored_count
+
+    def run_pipelines(self, delete=False, unlike=False):
+        # statuses/* and favorites/* are rate limited separately, so deleting and unliking can run side by side
+        results = {}
+        threads = []
+        if delete:
+            threads.append(threading.Thread(target=self.run_pipeline, args=("delete", self.delete_tweets, results), name="delete", daemon=True))
+        if unlike:
+            threads.append(threading.Thread(target=self.run_pipeline, args=("unlike", self.unlike_tweets, results), name="unlike", daemon=True))
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        if len(threads) < 2:
+            return
+        prefix = "SIMULATION: " if self.simulate else ""
+        for name, label in (("delete", "Tweets deleted"), ("unlike", "Tweets unliked")):
+            if results.get(name):
+                self.log("{}{}: {}, protected: {}".format(prefix, label, *results[name]))
+            else:
+                self.log("{}{}: did not finish".format(prefix, label))
+
+    def run_pipeline(self, name, func, results):
+        # tweepy's cursors swap api.parser while paging (breaking --raw for the other thread), so each thread gets its own API
+        if self.auth:
+            self.thread_state.api = self.create_api()
+        results[name] = func()
+
+    def enqueue_tweets(self, queue_path, tweets=True, likes=False):
+        # coordinator: split tweets/likes into chunks that workers can lease from the queue
+        if not self.api:
+            self.log("Could not authenticate. Please check the options set under [Authentication] in your configuration file.")
+            return
+        queue = WorkQueue(queue_path, self.lease_secs)
+        sources = []
+        if tweets:
+            sources.append(("tweet", False))
+        if likes:
+            sources.append(("like", True))
+        for kind, fav in sources:
+            chunk = []
+            chunk_count = 0
+            for tweet in self.fetch_tweets(fav):
+                chunk.append(tweet._json)
+                if len(chunk) >= self.chunk_size:
+                    queue.add_chunk(kind, chunk)
+                    chunk_count += 1
+                    chunk = []
+            if chunk:
+                queue.add_chunk(kind, chunk)
+                chunk_count += 1
+            self.log("Queued {} chunks of {}s in {}".format(chunk_count, kind, queue_path))
+
+    def work_queue(self, queue_path):
+        # worker: lease chunks from the queue and delete/unlike them until the queue is drained
+        if not self.api:
+            self.log("Could not authenticate. Please check the options set under [Authentication] in your configuration file.")
+            return
+        queue = WorkQueue(queue_path, self.lease_secs)
+        self.rate_budget = RateBudget(queue_path, "destroy", self.rate_per_hour or 300)
+        worker_id = "{}:{}".format(socket.gethostname(), os.getpid())
+        counts = {"deleted": 0, "protected": 0, "failed": 0}
+        self.log("Working on {} as {} (simulation={})".format(queue_path, worker_id, self.simulate))
+        while not self.budget_exhausted():
+            claimed = queue.claim(worker_id)
+            if claimed is None:
+                if not queue.outstanding():
+                    break
+                time.sleep(min(self.lease_secs, 30))  # other workers still hold leases, some may expire
+                continue
+            chunk_id, kind, items = claimed
+            unsaved = {"deleted": 0, "protected": 0, "failed": 0}  # results not yet stored in the queue
+            found = self.lookup_tweets([item["id_str"] for item in items]) if self.hydrate_tweets else None
+            if self.export and self.export_media:
+                for item in items:
+                    self.submit_media(tweepy.models.Status.parse(self.api, item))  # download the chunk's media ahead
+            for ind, item in enumerate(items):
+                if self.budget_exhausted():
+                    queue.release(chunk_id, worker_id, items[ind:], unsaved)
+                    break
+                # store the progress and extend the lease before the next (possibly long) request,
+                # so a worker taking over after a crash or an expired lease starts with this tweet
+                if not queue.renew(chunk_id, worker_id, items[ind:], unsaved):
+                    self.log("Lost the lease on chunk {}, leaving it to another worker".format(chunk_id))
+                    break
+                unsaved = {"deleted": 0, "protected": 0, "failed": 0}
+                tweet = tweepy.models.Status.parse(self.api, item)
+                if found is not None:
+                    current = found.get(item["id_str"])
+                    if current is None or (kind == "like" and not current.favorited):
+                        self.gone_count += 1  # deleted or already unliked since it was queued
+                        continue
+                    self.refresh_counts(tweet, current)
+                result = self.process_tweet(tweet, fav=(kind == "like"))
+                if result == "gone":
+                    continue
+                unsaved[result] += 1
+                counts[result] += 1
+            else:
+                queue.complete(chunk_id, worker_id, unsaved)
+        if self.budget_exhausted():
+            self.log("Stopping early, {}.".format(self.budget_exhausted()))
+        self.log("This worker: {} deleted/unliked, {} protected, {} failed, {} already gone.".format(counts["deleted"], counts["protected"], counts["failed"], self.gone_count))
+        totals = queue.totals()
+        self.log("All workers: {} of {} chunks done, {} deleted/unliked, {} protected, {} failed.".format(totals["done"], totals["chunks"], totals["deleted"], totals["protected"], totals["failed"]))
+
+
+def iter_json_objects(text, pos=0):
+    # (start, end, object) for each top-level JSON object in text, skipping whatever lies between them
+    decoder = json.JSONDecoder()
+    while True:
+        start = text.find("{", pos)
+        if start == -1:
+            return
+        obj, pos = decoder.raw_decode(text, start)
+        yield start, pos, obj
+
+
+def iter_json_file(handle, chunk_size=1 << 20):
+    # like iter_json_objects, but reads the file piecewise so memory does not grow with its size
+    decoder = json.JSONDecoder()
+    buf = ""
+    pos = 0
+    while True:
+        start = buf.find("{", pos)
+        if start != -1:
+            try:
+                obj, pos = decoder.raw_decode(buf, start)
+            except ValueError:
+                pass  # object continues in the next piece
+            else:
+                yield obj
+                continue
+        data = handle.read(chunk_size)
+        if not data:
+            if start != -1:
+                decoder.raw_decode(buf, start)  # raises the actual parse error
+            return
+        buf = (buf[start:] if start != -1 else "") + data
+        pos = 0
+
+
+def tweet_start_in_line(line):
+    # offset of a top-level tweet object starting on this line: one tweet per line,
+    # or the two layouts of tweet.js ("}, {" between tweets, or each "{" on its own indented line)
+    if line.startswith(b"{"):
+        return 0
+    if line.startswith(b"}, {"):
+        return 3
+    if line.rstrip(b"\r\n") == b"  {":
+        return 2
+    return None
+
+
+def archive_shards(archive_path, count, min_size=1 << 20, max_size=16 << 20):
+    # byte ranges of the archive that each start at a top-level tweet; a worker reads one range
+    # at a time, so large archives get more ranges instead of larger ones
+    size = os.path.getsize(archive_path)
+    count = max(1, min(count, size // min_size), -(-size // max_size))
+    bounds = [0]
+    with open(archive_path, "rb") as h:
+        for k in range(1, count):
+            h.seek(max(bounds[-1], k * size // count))
+            h.readline()  # most likely landed in the middle of a line
+            while True:
+                pos = h.tell()
+                line = h.readline()
+                if not line or tweet_start_in_line(line) is not None:
+                    break
+            if not line:
+                break
+            start = pos + tweet_start_in_line(line)
+            if start > bounds[-1]:
+                bounds.append(start)
+    bounds.append(size)
+    return [(archive_path, start, end) for start, end in zip(bounds, bounds[1:])]
+
+
+_shard_rules = None
+_shard_archive_log = None
+_shard_verbose = False
+
+
+def init_shard_worker(rules, archive_log_path=None, verbose=False):
+    global _shard_rules, _shard_archive_log, _shard_verbose
+    _shard_rules = rules
+    _shard_verbose = verbose
+    if archive_log_path:
+        _shard_archive_log = ArchiveLog(archive_log_path)
+
+
+def protected_by_rules(id_str, created_at, text, favorite_count, retweet_count, rules):
+    # the keep checks of is_protected_tweet/is_protected_like, also run by the --jobs workers
+    text_lower = text.lower()
+    return (id_str in rules["ids"]
+            or created_at >= rules["cutoff"]
+            or any(k in text_lower for k in rules["keywords"])
+            or (rules["liked_threshold"] != -1 and favorite_count >= rules["liked_threshold"])
+            or (rules["retweet_threshold"] != -1 and retweet_count >= rules["retweet_threshold"]))
+
+
+def evaluate_shard(shard):
+    # (deleted, protected, gone, kept) counts for the shard; kept lists (id_str, created_at) of protected tweets with --verbose
+    archive_path, start, end = shard
+    with open(archive_path, "rb") as h:
+        h.seek(start)
+        text = h.read(end - start).decode("utf-8")
+    deleted = protected = gone = 0
+    kept = []
+    for _, _, obj in iter_json_objects(text):
+        tweet = normalise_archive_tweet(obj.get("tweet", obj))
+        if _shard_archive_log and tweet["id_str"] in _shard_archive_log:
+            gone += 1  # deleted by an earlier run
+            continue
+        created_at = datetime.datetime.strptime(tweet["created_at"], "%a %b %d %H:%M:%S +0000 %Y")
+        if protected_by_rules(tweet["id_str"], created_at, tweet.get("text", ""),
+                              tweet.get("favorite_count", 0), tweet.get("retweet_count", 0), _shard_rules):
+            protected += 1
+            if _shard_verbose:
+                kept.append((tweet["id_str"], created_at))
+        else:
+            deleted += 1
+    return deleted, protected, gone, kept
+
+
+def normalise_archive_tweet(tweet):
+    # archives use full_text and store the counts as strings
+    if "text" not in tweet and "full_text" in tweet:
+        tweet["text"] = tweet["full_text"]
+    for k in ("favorite_count", "retweet_count"):
+        if k in tweet:
+            tweet[k] = int(tweet[k])
+    return tweet
+
+
+def is_not_found(error):
+    # 404, or error 144 ("No status found with that ID"), when destroying a tweet/like that is already gone
+    response = getattr(error, "response", None)
+    return getattr(error, "api_code", None) == 144 or (response is not None and response.status_code == 404)
+
+
+class RawCaptureParser(tweepy.parsers.ModelParser):
+    """Keeps each status' JSON text exactly as received, so exports can write it without re-serializing."""
+    def parse(self, method, payload, *args, **kwargs):
+        if method.payload_type != "status" or not method.payload_list:
+            return super().parse(method, payload, *args, **kwargs)
+        results = tweepy.models.ResultSet()
+        for start, end, obj in iter_json_objects(payload):
+            status = tweepy.models.Status.parse(method.api, obj)
+            status._raw_json = payload[start:end]
+            results.append(status)
+        return results
+
+
+def open_state_db(db_path):
+    db = sqlite3.connect(db_path, timeout=60, isolation_level=None, check_same_thread=False)
+    db.executescript("""
+        CREATE TABLE IF NOT EXISTS chunks (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            items TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            owner TEXT,
+            lease_until REAL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            deleted INTEGER NOT NULL DEFAULT 0,
+            protected INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE TABLE IF NOT EXISTS budget (
+            key TEXT PRIMARY KEY,
+            tokens REAL NOT NULL,
+            updated REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS archive_done (
+            id_str TEXT PRIMARY KEY
+        );
+    """)
+    return db
+
+
+class WorkQueue():
+    """Chunks of candidate tweets in a SQLite file, leased to one worker at a time."""
+    def __init__(self, db_path, lease_secs=1200):
+        self.lease_secs = lease_secs
+        self.db = open_state_db(db_path)
+
+    def add_chunk(self, kind, items):
+        self.db.execute("INSERT INTO chunks (kind, items) VALUES (?, ?)", (kind, json.dumps(items)))
+
+    def claim(self, worker_id):
+        now = time.time()
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            row = self.db.execute("SELECT id, kind, items FROM chunks WHERE status = 'pending' OR (status = 'leased' AND lease_until < ?) ORDER BY id LIMIT 1", (now,)).fetchone()
+            if row:
+                self.db.execute("UPDATE chunks SET status = 'leased', owner = ?, lease_until = ?, attempts = attempts + 1 WHERE id = ?", (worker_id, now + self.lease_secs, row[0]))
+        except sqlite3.Error:
+            self.db.execute("ROLLBACK")
+            raise
+        self.db.execute("COMMIT")
+        if not row:
+            return None
+        return row[0], row[1], json.loads(row[2])
+
+    def renew(self, chunk_id, worker_id, remaining_items, counts):
+        # extend the lease and save the progress made since the last renewal
+        cur = self.db.execute("UPDATE chunks SET lease_until = ?, items = ?, deleted = deleted + ?, protected = protected + ?, failed = failed + ? WHERE id = ? AND owner = ? AND status = 'leased'", (time.time() + self.lease_secs, json.dumps(remaining_items), counts["deleted"], counts["protected"], counts["failed"], chunk_id, worker_id))
+        return cur.rowcount == 1
+
+    def complete(self, chunk_id, worker_id, counts):
+        self.db.execute("UPDATE chunks SET status = 'done', lease_until = NULL, deleted = deleted + ?, protected = protected + ?, failed = failed + ? WHERE id = ? AND owner = ?", (counts["deleted"], counts["protected"], counts["failed"], chunk_id, worker_id))
+
+    def release(self, chunk_id, worker_id, remaining_items, counts):
+        # hand back the unprocessed rest of a chunk, keeping the results so far
+        self.db.execute("UPDATE chunks SET status = 'pending', owner = NULL, lease_until = NULL, items = ?, deleted = deleted + ?, protected = protected + ?, failed = failed + ? WHERE id = ? AND owner = ?", (json.dumps(remaining_items), counts["deleted"], counts["protected"], counts["failed"], chunk_id, worker_id))
+
+    def outstanding(self):
+        return self.db.execute("SELECT COUNT(*) FROM chunks WHERE status != 'done'").fetchone()[0]
+
+    def totals(self):
+        row = self.db.execute("SELECT COUNT(*), SUM(status = 'done'), SUM(deleted), SUM(protected), SUM(failed) FROM chunks").fetchone()
+        return dict(zip(["chunks", "done", "deleted", "protected", "failed"], [v or 0 for v in row]))
+
+
+class RateBudget():
+    """Token bucket kept in a SQLite file, so every process using the file draws from one request budget."""
+    def __init__(self, db_path, key, per_hour, capacity=None):
+        self.key = key
+        self.rate = per_hour / 3600.0
+        self.capacity = capacity or max(1.0, per_hour / 60.0)  # by default, bursts of about a minute's worth of requests
+        self.db = open_state_db(db_path)
+        self.lock = threading.Lock()  # the connection may be shared by the delete and unlike threads
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                granted, tokens = self.take()
+            if granted:
+                return
+            time.sleep((1 - tokens) / self.rate)
+
+    def take(self):
+        now = time.time()
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            row = self.db.execute("SELECT tokens, updated FROM budget WHERE key = ?", (self.key,)).fetchone()
+            if row:
+                tokens = min(self.capacity, row[0] + (now - row[1]) * self.rate)
+            else:
+                tokens = self.capacity
+            granted = tokens >= 1
+            if granted:
+                tokens -= 1
+            self.db.execute("INSERT OR REPLACE INTO budget (key, tokens, updated) VALUES (?, ?, ?)", (self.key, tokens, now))
+        except sqlite3.Error:
+            self.db.execute("ROLLBACK")
+            raise
+        self.db.execute("COMMIT")
+        return granted, tokens
+
+
+class ArchiveLog():
+    """IDs of archived tweets that are deleted or gone, so later --archive runs skip them instead of spending requests."""
+    def __init__(self, db_path):
+        self.db = open_state_db(db_path)
+        self.lock = threading.Lock()
+
+    def add(self, id_str):
+        with self.lock:
+            self.db.execute("INSERT OR IGNORE INTO archive_done (id_str) VALUES (?)", (id_str,))
+
+    def __contains__(self, id_str):
+        with self.lock:
+            return self.db.execute("SELECT 1 FROM archive_done WHERE id_str = ?", (id_str,)).fetchone() is not None
 
 
 def comma_string_to_list(s):
    return s.split(',')
 
-if __name__ == "__main__":
+def build_parser():
     parser = argparse.ArgumentParser(description='Unlike or delete (re-)tweets (and optionally export them first). Set other parameters via configuration file (default: "settings.ini" in script directory) or arguments. Set arguments will overrule the configuration file.')
     parser.add_argument("--delete", dest="delete_tweets", help="delete tweets", action="store_true")
     parser.add_argument("--unlike", dest="unlike_tweets", help="unlike tweets", action="store_true")
     parser.add_argument("--export", dest="export_tweets", help = "export before deleting/unliking", action="store_true")
+    parser.add_argument("--raw", dest="raw_export", help = "export tweets exactly as received (compact JSON, faster)", action="store_true")
+    parser.add_argument("--media", dest="export_media", help = "also export images/videos (with --export)", action="store_true")
+    parser.add_argument("--media-workers", default=4, metavar="N", dest="media_workers", type=int, help="download N media files at a time", action="store")
     parser.add_argument("--simulate", dest="simulate", help = "only simulate the process", action="store_true")
     parser.add_argument("--verbose", dest="verbose", help = "enable detailed output", action="store_true")
     parser.add_argument("--config", default="settings.ini", metavar="PATH", dest="config_path", help='custom config path (for multiple profiles)', type=str, action="store")
@@ -447,11 +1331,32 @@ if __name__ == "__main__":
     parser.add_argument("--tweetkws", default=[], metavar="KW,KW,...", dest="tweet_keywords_to_keep", type = comma_string_to_list, help="comma-separated list of keywords for tweets", action="store")
     parser.add_argument("--likedids", default=[], metavar="ID,ID,...", dest="liked_ids_to_keep", type = comma_string_to_list, help="comma-separated tweet ids for liked tweets", action="store")
     parser.add_argument("--likedkws", default=[], metavar="KW,KW,...", dest="liked_keywords_to_keep", type = comma_string_to_list, help="comma-separated list of keywords for liked tweets", action="store")
-    
+    parser.add_argument("--enqueue", metavar="PATH", dest="enqueue_path", help="queue tweets/likes as work chunks in a queue file instead of deleting/unliking them", type=str, action="store")
+    parser.add_argument("--worker", metavar="PATH", dest="worker_path", help="delete/unlike the chunks queued in a queue file", type=str, action="store")
+    parser.add_argument("--chunk", default=100, metavar="N", dest="chunk_size", type=int, help="queue N tweets per work chunk", action="store")
+    parser.add_argument("--lease", default=1200, metavar="N", dest="lease_secs", type=int, help="hand a chunk to another worker after N seconds without progress", action="store")
+    parser.add_argument("--max-runtime", metavar="N", dest="max_runtime", type=int, help="stop after N minutes (--priority collects candidates for at most half of them)", action="store")
+    parser.add_argument("--max-requests", metavar="N", dest="max_requests", type=int, help="stop after N delete/unlike requests (simulated ones included)", action="store")
+    parser.add_argument("--priority", choices=["oldest", "engagement"], dest="priority", help="collect all candidates first, then delete/unlike the oldest or least liked/retweeted ones first", action="store")
+    parser.add_argument("--archive", metavar="PATH", dest="archive_path", help="take the tweets to delete from an archive (tweet.js or one JSON tweet per line) instead of the timeline", type=str, action="store")
+    parser.add_argument("--jobs", default=1, metavar="N", dest="jobs", type=int, help="simulate over an --archive on N processes (not with --export, --hydrate, --priority, --max-requests or --max-runtime)", action="store")
+    parser.add_argument("--hydrate", dest="hydrate_tweets", help="refresh likes/retweets of archived/queued tweets (100 per request) and skip tweets that are already gone", action="store_true")
+    parser.add_argument("--shared-rate", metavar="N", dest="shared_rate", type=int, help="share N delete and N unlike requests per hour (and the timeline/likes/lookup rate limits) with all other runs for the same account on this host", action="store")
+    parser.add_argument("--single-instance", dest="single_instance", help="exit if another run for the same account is still going on this host", action="store_true")
+    parser.add_argument("--rate", metavar="N", dest="rate_per_hour", type=int, help="share N delete/unlike requests per hour between all workers (default: 300)", action="store")
+    return parser
+
+if __name__ == "__main__":
+    parser = build_parser()
     args = parser.parse_args()
     td = TweetDeleter(args)
+    if args.single_instance and td.api and not td.acquire_instance_lock():
+        print("Another run for this account is still going, exiting.")
+        sys.exit(0)
     print(td)
-    if args.delete_tweets:
-        td.delete_tweets()
-    if args.unlike_tweets:
-        td.unlike_tweets()
+    if args.enqueue_path:
+        td.enqueue_tweets(args.enqueue_path, tweets=args.delete_tweets, likes=args.unlike_tweets)
+    elif args.worker_path:
+        td.work_queue(args.worker_path)
+    else:
+        td.run_pipelines(delete=args.delete_tweets, unlike=args.unlike_tweets)
@@ -0,0 +1,160 @@
+import datetime
+import functools
+import json
+import os
+import sys
+import types
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+try:
+    import tweepy  # noqa: F401
+except ImportError:
+    # just enough of tweepy 3.x to import cleantweets; the tests replace the API and Cursor anyway
+    @functools.lru_cache(maxsize=None)
+    def parse_datetime(s):
+        return datetime.datetime.strptime(s, "%a %b %d %H:%M:%S +0000 %Y")
+
+    class TweepError(Exception):
+        def __init__(self, reason, response=None, api_code=None):
+            super().__init__(reason)
+            self.reason = reason
+            self.response = response
+            self.api_code = api_code
+
+    class ResultSet(list):
+        pass
+
+    class Status(object):
+        @classmethod
+        def parse(cls, api, json):
+            status = cls()
+            status._api = api
+            status._json = json
+            for k, v in json.items():
+                if k == "created_at":
+                    v = parse_datetime(v)
+                setattr(status, k, v)
+            return status
+
+    class ModelParser(object):
+        def parse(self, method, payload, *args, **kwargs):
+            data = json.loads(payload)
+            if isinstance(data, list):
+                return ResultSet(Status.parse(method.api, obj) for obj in data)
+            return Status.parse(method.api, data)
+
+    class Unavailable(object):
+        def __init__(self, *args, **kwargs):
+            raise TweepError("tweepy is not installed")
+
+    stub = types.ModuleType("tweepy")
+    stub.error = types.ModuleType("tweepy.error")
+    stub.error.TweepError = TweepError
+    stub.models = types.ModuleType("tweepy.models")
+    stub.models.Status = Status
+    stub.models.ResultSet = ResultSet
+    stub.parsers = types.ModuleType("tweepy.parsers")
+    stub.parsers.ModelParser = ModelParser
+    stub.TweepError = TweepError
+    stub.API = stub.OAuthHandler = stub.Cursor = Unavailable
+    sys.modules.update({"tweepy": stub, "tweepy.error": stub.error, "tweepy.models": stub.models, "tweepy.parsers": stub.parsers})
+
+import cleantweets  # noqa: E402  (needs tweepy or the stub above)
+
+FIRST_ID = 1000000000000000000
+CONFIG = """[Authentication]
+ConsumerKey = ck
+ConsumerSecret = cs
+AccessToken = at
+AccessTokenSecret = ats
+
+[DefaultValues]
+MinsToWait = 1
+DaysToKeep =
+LikedThreshold =
+RetweetThreshold =
+
+[DefaultPaths]
+TweetIDsPath =
+LikedIDsPath =
+TweetKeywordsPath =
+LikedKeywordsPath =
+"""
+
+
+class FakeAPI(object):
+    """Timeline and likes of `size` tweets each, generated page by page, newest first."""
+    first_id = FIRST_ID
+    def __init__(self):
+        self.size = 0
+        self.distinct_ids = None  # ids repeat after this many tweets, so exports overwrite a few files
+        self.destroyed = 0
+        self.deleted_ids = None  # a set to remember deleted ids and answer like Twitter when they are deleted again
+
+    def user_timeline(self, max_id=None, count=200, include_rts=True):
+        return self.pages(max_id, count)
+
+    def favorites(self, max_id=None, count=200):
+        return self.pages(max_id, count)
+
+    def pages(self, max_id, count):
+        start = 0 if max_id is None else FIRST_ID - max_id
+        for page_start in range(start, self.size, count):
+            yield [self.tweet(n) for n in range(page_start, min(page_start + count, self.size))]
+
+    def tweet(self, n):
+        tweet_id = FIRST_ID - (n % self.distinct_ids if self.distinct_ids else n)
+        return cleantweets.tweepy.models.Status.parse(self, {
+            "id": tweet_id,
+            "id_str": str(tweet_id),
+            "created_at": "Mon Jan 01 12:00:00 +0000 2018",
+            "text": "Synthetic tweet number {} with a few more words to reach a typical length".format(n),
+            "favorite_count": n % 97,
+            "retweet_count": n % 13,
+            "favorited": True,
+        })
+
+    def destroy_status(self, tweet_id):
+        self.destroyed += 1
+        if self.deleted_ids is not None:
+            if tweet_id in self.deleted_ids:
+                raise cleantweets.tweepy.error.TweepError("No status found with that ID.", api_code=144)
+            self.deleted_ids.add(tweet_id)
+
+    destroy_favorite = destroy_status
+
+
+class FakeCursor(object):
+    def __init__(self, method, **kwargs):
+        self.method = method
+        self.kwargs = kwargs
+
+    def items(self):
+        for page in self.method(**self.kwargs):
+            for tweet in page:
+                yield tweet
+
+    def pages(self):
+        return iter(self.method(**self.kwargs))
+
+
+@pytest.fixture
+def make_deleter(tmp_path, monkeypatch):
+    def fake_authenticate(self, consumer_key, consumer_secret, access_token, access_token_secret):
+        self.account_key = "test"
+        self.api = FakeAPI()
+
+    monkeypatch.setattr(sys, "argv", [str(tmp_path / "cleantweets.py")])  # script_dir, so exports go to tmp_path
+    monkeypatch.setattr(cleantweets.TweetDeleter, "authenticate", fake_authenticate)
+    monkeypatch.setattr(cleantweets.tweepy, "Cursor", FakeCursor)
+    (tmp_path / "settings.ini").write_text(CONFIG)
+
+    def make(*argv, size=0):
+        args = cleantweets.build_parser().parse_args(["--days", "0"] + list(argv))
+        td = cleantweets.TweetDeleter(args)
+        td.api.size = size
+        return td
+    return make
@@ -0,0 +1,60 @@
+"""Repeated --archive runs on a stub API: every run must get further into the archive."""
+import json
+
+import cleantweets
+
+
+def write_archive(path, api, count):
+    with open(path, "w") as h:
+        for n in range(count):
+            h.write(json.dumps(api.tweet(n)._json) + "\n")
+
+
+def test_budgeted_archive_runs_make_progress(make_deleter, tmp_path):
+    archive = tmp_path / "tweets.jsonl"
+    deleted_ids = set()
+    results = []
+    for run in range(3):
+        td = make_deleter("--archive", str(archive), "--max-requests", "10")
+        if not run:
+            write_archive(archive, td.api, 50)
+        td.api.deleted_ids = deleted_ids
+        results.append(td.delete_tweets())
+        assert td.api.destroyed == 10  # no requests spent on tweets deleted by earlier runs
+    assert results == [(10, 0)] * 3
+    assert len(deleted_ids) == 30
+
+
+def test_already_deleted_tweet_is_gone_not_failed(make_deleter):
+    td = make_deleter(size=5)
+    gone = td.api.tweet(1)
+    td.api.deleted_ids = {gone.id_str}
+    assert td.process_tweet(gone) == "gone"
+    assert td.delete_tweets() == (4, 0)
+    assert td.gone_count == 2
+
+
+def test_plain_archive_run_is_not_capped(make_deleter, tmp_path, monkeypatch):
+    # without --priority the archive is streamed in file order, like the --jobs path
+    monkeypatch.setattr(cleantweets.TweetDeleter, "priority_limit", 10)
+    archive = tmp_path / "tweets.jsonl"
+    td = make_deleter("--archive", str(archive), "--simulate", "--likes", "40")
+    write_archive(archive, td.api, 60)
+    sequential = td.delete_tweets()
+    parallel = make_deleter("--archive", str(archive), "--simulate", "--likes", "40", "--jobs", "3").delete_tweets()
+    assert sequential == parallel == (40, 20)
+
+
+def test_archive_shards_stay_small(make_deleter, tmp_path):
+    archive = tmp_path / "tweets.jsonl"
+    td = make_deleter("--archive", str(archive), "--simulate", "--likes", "40", "--verbose")
+    write_archive(archive, td.api, 2000)
+    shards = cleantweets.archive_shards(str(archive), 2, min_size=1, max_size=20000)
+    assert len(shards) >= archive.stat().st_size // 20000
+    assert max(end - start for _, start, end in shards) < 2*20000
+    cleantweets.init_shard_worker(td.keep_rules(), verbose=True)
+    results = [cleantweets.evaluate_shard(shard) for shard in shards]
+    deleted, protected, gone = (sum(r[i] for r in results) for i in range(3))
+    assert (deleted, protected) == td.delete_tweets()
+    assert gone == 0
+    assert sum(len(r[3]) for r in results) == protected
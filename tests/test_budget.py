@@ -0,0 +1,25 @@
+"""--shared-rate: page fetches and lookups draw from the shared per-account buckets too."""
+import os
+import sqlite3
+
+
+def tokens_left(td, key):
+    db = sqlite3.connect(os.path.join(td.state_dir, "budget_{}.sqlite".format(td.account_key)))
+    try:
+        return db.execute("SELECT tokens FROM budget WHERE key = ?", (key,)).fetchone()[0]
+    finally:
+        db.close()
+
+
+def test_timeline_pages_use_the_shared_budget(make_deleter):
+    td = make_deleter("--shared-rate", "100", "--simulate", size=450)
+    assert td.delete_tweets() == (450, 0)
+    # three pages plus the request that finds no more
+    assert round(tokens_left(td, "user_timeline")) == td.read_limits["user_timeline"] - 4
+
+
+def test_lookups_use_the_shared_budget(make_deleter):
+    td = make_deleter("--shared-rate", "100")
+    td.api.statuses_lookup = lambda ids: []
+    assert td.lookup_tweets([str(n) for n in range(250)]) == {}
+    assert round(tokens_left(td, "statuses_lookup")) == td.read_limits["statuses_lookup"] - 3
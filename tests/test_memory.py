@@ -0,0 +1,70 @@
+"""Peak memory of the long-running paths on synthetic timelines, measured with tracemalloc.
+
+Streaming deletes/unlikes/exports must not grow with the length of the timeline, and
+--priority must not keep more than its cap of candidates, with or without --max-requests.
+"""
+import os
+import tracemalloc
+
+import pytest
+
+import cleantweets
+
+MB = 1 << 20
+STREAM_PEAK = 2*MB  # a page of 200 tweets plus bookkeeping
+PRIORITY_PEAK = 32*MB  # cleantweets.TweetDeleter.priority_limit candidates
+SIZES = [100000, pytest.param(1000000, marks=pytest.mark.skipif(not os.environ.get("CLEANTWEETS_1M_TESTS"),
+                                                               reason="takes minutes, set CLEANTWEETS_1M_TESTS=1"))]
+
+
+def peak_of(func, *args):
+    tracemalloc.start()
+    try:
+        result = func(*args)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return result, peak
+
+
+@pytest.mark.parametrize("size", SIZES)
+def test_delete_tweets_memory(make_deleter, size):
+    td = make_deleter(size=size)
+    result, peak = peak_of(td.delete_tweets)
+    assert result == (size, 0)
+    assert td.api.destroyed == size
+    assert peak < STREAM_PEAK
+
+
+@pytest.mark.parametrize("size", SIZES)
+def test_unlike_tweets_memory(make_deleter, size):
+    td = make_deleter(size=size)
+    result, peak = peak_of(td.unlike_tweets)
+    assert result == (size, 0)
+    assert td.api.destroyed == size
+    assert peak < STREAM_PEAK
+
+
+@pytest.mark.parametrize("size", SIZES)
+def test_export_to_json_memory(make_deleter, size):
+    td = make_deleter("--export", "--simulate", size=size)
+    td.api.distinct_ids = 1000
+    result, peak = peak_of(td.delete_tweets)
+    assert result == (size, 0)
+    assert len(os.listdir(td.export_dir)) == 1000
+    assert peak < STREAM_PEAK
+
+
+@pytest.mark.parametrize("size", SIZES)
+@pytest.mark.parametrize("max_requests", [None, 1000])
+def test_prioritise_memory(make_deleter, size, max_requests):
+    argv = ["--priority", "oldest"]
+    if max_requests:
+        argv += ["--max-requests", str(max_requests)]
+    td = make_deleter(*argv, size=size)
+    (candidates, candidate_count, protected_count), peak = peak_of(td.prioritise, td.fetch_tweets())
+    cap = max_requests or cleantweets.TweetDeleter.priority_limit
+    assert (candidate_count, protected_count) == (size, 0)
+    assert len(candidates) == cap
+    assert candidates[-1]["id"] == td.api.first_id - size + 1  # oldest popped first
+    assert peak < (STREAM_PEAK if max_requests else PRIORITY_PEAK)